@@ -14,3 +14,8 @@ class Command(BaseCommand):
         self.stdout.write("Cleaning query records…")
         models.Query.garbage_collect()
         self.stdout.write("Done")
+
+        # Update view counts from the remaining daily hits
+        self.stdout.write("Updating query view counts…")
+        models.Query.update_views_past_week()
+        self.stdout.write("Done")
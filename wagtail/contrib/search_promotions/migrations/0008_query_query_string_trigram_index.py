@@ -0,0 +1,51 @@
+from django.db import DatabaseError, migrations, transaction
+
+INDEX_NAME = "wagtailsearchpromotions_query_string_trgm"
+
+
+def create_trigram_index(apps, schema_editor):
+    """
+    On PostgreSQL, add a trigram index to speed up the case-insensitive substring
+    matching (icontains) used to search queries in the query chooser.
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+
+    try:
+        # Creating an extension may require privileges that the database user
+        # does not have, so don't fail the migration if that is the case
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DatabaseError:
+        return
+
+    Query = apps.get_model("wagtailsearchpromotions.Query")
+    # Django's icontains lookup compares UPPER("query_string"::text) on PostgreSQL,
+    # so the index must be on the same expression to be used
+    schema_editor.execute(
+        "CREATE INDEX IF NOT EXISTS %s ON %s USING gin (UPPER(%s::text) gin_trgm_ops)"
+        % (
+            schema_editor.quote_name(INDEX_NAME),
+            schema_editor.quote_name(Query._meta.db_table),
+            schema_editor.quote_name("query_string"),
+        )
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+
+    schema_editor.execute(
+        "DROP INDEX IF EXISTS %s" % schema_editor.quote_name(INDEX_NAME)
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("wagtailsearchpromotions", "0007_searchpromotion_external_link_text_and_more"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
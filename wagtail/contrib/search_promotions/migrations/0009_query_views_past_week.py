@@ -0,0 +1,31 @@
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def populate_views_past_week(apps, schema_editor):
+    Query = apps.get_model("wagtailsearchpromotions.Query")
+    QueryDailyHits = apps.get_model("wagtailsearchpromotions.QueryDailyHits")
+
+    hits = (
+        QueryDailyHits.objects.filter(query=models.OuterRef("pk"))
+        .order_by()
+        .values("query")
+        .annotate(total=models.Sum("hits"))
+        .values("total")
+    )
+    Query.objects.update(views_past_week=Coalesce(models.Subquery(hits), 0))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("wagtailsearchpromotions", "0008_query_query_string_trigram_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="query",
+            name="views_past_week",
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(populate_views_past_week, migrations.RunPython.noop),
+    ]
@@ -2,6 +2,7 @@ import datetime
 
 from django.conf import settings
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
@@ -10,6 +11,7 @@ from wagtail.search.utils import MAX_QUERY_STRING_LENGTH, normalise_query_string
 
 class Query(models.Model):
     query_string = models.CharField(max_length=MAX_QUERY_STRING_LENGTH, unique=True)
+    views_past_week = models.PositiveIntegerField(default=0, db_index=True)
 
     def save(self, *args, **kwargs):
         # Normalise query string
@@ -48,6 +50,24 @@ class Query(models.Model):
         )
         cls.objects.filter(daily_hits__isnull=True, **extra_filter_kwargs).delete()
 
+    @classmethod
+    def update_views_past_week(cls):
+        """
+        Updates the views_past_week field of all Query records to the sum of their
+        daily hits. Old daily hits are removed by QueryDailyHits.garbage_collect,
+        so this only covers the past week by default.
+        """
+        hits = (
+            QueryDailyHits.objects.filter(query=models.OuterRef("pk"))
+            .order_by()
+            .values("query")
+            .annotate(total=models.Sum("hits"))
+            .values("total")
+        )
+        cls.objects.update(
+            views_past_week=Coalesce(models.Subquery(hits), 0),
+        )
+
     @classmethod
     def get(cls, query_string):
         return cls.objects.get_or_create(
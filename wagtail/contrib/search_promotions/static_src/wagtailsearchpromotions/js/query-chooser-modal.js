@@ -1,11 +1,20 @@
 QUERY_CHOOSER_MODAL_ONLOAD_HANDLERS = {
   chooser: function (modal, jsonData) {
+    // Cursors of the pages navigated through, most recent last
+    var cursors = [];
+
     function ajaxifyLinks(context) {
       $('.listing a.choose-query', context).on('click', chooseQuery);
 
-      $('.pagination a', context).on('click', function () {
-        var page = this.getAttribute('data-page');
-        setPage(page);
+      $('.pagination .next a', context).on('click', function () {
+        cursors.push(this.getAttribute('data-cursor'));
+        setPage();
+        return false;
+      });
+
+      $('.pagination .prev a', context).on('click', function () {
+        cursors.pop();
+        setPage();
         return false;
       });
     }
@@ -14,6 +23,7 @@ QUERY_CHOOSER_MODAL_ONLOAD_HANDLERS = {
     var request;
 
     function search() {
+      cursors = [];
       request = $.ajax({
         url: searchUrl,
         data: { q: $('#id_q').val() },
@@ -28,13 +38,14 @@ QUERY_CHOOSER_MODAL_ONLOAD_HANDLERS = {
       });
       return false;
     }
-    function setPage(page) {
-      var dataObj;
+    function setPage() {
+      var dataObj = {};
 
       if ($('#id_q').val().length) {
-        dataObj = { q: $('#id_q').val(), p: page };
-      } else {
-        dataObj = { p: page };
+        dataObj.q = $('#id_q').val();
+      }
+      if (cursors.length) {
+        dataObj.after = cursors[cursors.length - 1];
       }
 
       request = $.ajax({
@@ -7,6 +7,7 @@ from django.core import management
 from django.test import TestCase
 from django.urls import reverse
 from django.utils import timezone
+from freezegun import freeze_time
 from openpyxl import load_workbook
 
 from wagtail.admin.admin_url_finder import AdminURLFinder
@@ -19,6 +20,7 @@ from wagtail.contrib.search_promotions.models import (
 from wagtail.contrib.search_promotions.templatetags.wagtailsearchpromotions_tags import (
     get_search_promotions,
 )
+from wagtail.models import ModelLogEntry, Page
 from wagtail.test.utils import WagtailTestUtils
 
 
@@ -274,7 +276,7 @@ class TestSearchPromotionsIndexView(WagtailTestUtils, TestCase):
         self.client.get(url)
 
         # Number of queries with the current number of search picks
-        with self.assertNumQueries(11):
+        with self.assertNumQueries(10):
             self.client.get(url)
 
         # Add more SearchPromotions and QueryDailyHits to some of the queries
@@ -290,6 +292,14 @@ class TestSearchPromotionsIndexView(WagtailTestUtils, TestCase):
                 )
                 for j in range(5)
             ]
+            promos.append(
+                SearchPromotion(
+                    query=query,
+                    external_link_url="https://wagtail.org",
+                    external_link_text="Wagtail",
+                    sort_order=5,
+                )
+            )
             hits = [
                 QueryDailyHits(query=query, date=today - timedelta(days=j), hits=j)
                 for j in range(5)
@@ -299,7 +309,7 @@ class TestSearchPromotionsIndexView(WagtailTestUtils, TestCase):
 
         # Number of queries after the addition of more search picks and hits
         # should remain the same (no N+1 queries)
-        with self.assertNumQueries(11):
+        with self.assertNumQueries(10):
             self.client.get(url)
 
     def test_results_are_ordered_alphabetically(self):
@@ -344,6 +354,7 @@ class TestSearchPromotionsIndexView(WagtailTestUtils, TestCase):
             sort_order=0,
             description="Second search pick",
         )
+        Query.update_views_past_week()
         response = self.client.get(reverse("wagtailsearchpromotions:index"))
 
         self.assertContains(response, "<td>10</td>", html=True)
@@ -358,6 +369,26 @@ class TestSearchPromotionsIndexView(WagtailTestUtils, TestCase):
         self.assertIsNotNone(homepage_edit_link)
         self.assertEqual(Query.get("root page").editors_picks.count(), 2)
 
+    def test_searchpromotions_preview(self):
+        query = Query.get("many promotions")
+        SearchPromotion.objects.bulk_create(
+            [
+                SearchPromotion(
+                    query=query,
+                    external_link_url=f"https://example.com/{i}/",
+                    external_link_text=f"Example {i}",
+                    sort_order=i,
+                )
+                for i in range(7)
+            ]
+        )
+        response = self.client.get(reverse("wagtailsearchpromotions:index"))
+
+        soup = self.get_soup(response.content)
+        self.assertIsNotNone(soup.select_one('a[href="https://example.com/4/"]'))
+        self.assertIsNone(soup.select_one('a[href="https://example.com/5/"]'))
+        self.assertContains(response, "and 2 more")
+
     def test_results_ordering(self):
         self.make_search_picks()
         url = reverse("wagtailsearchpromotions:index")
@@ -395,6 +426,8 @@ class TestSearchPromotionsIndexView(WagtailTestUtils, TestCase):
             description="Not as popular",
         )
 
+        Query.update_views_past_week()
+
         # ordered by querystring (reversed)
         response = self.client.get(url + "?ordering=-query_string")
         self.assertEqual(response.status_code, 200)
@@ -491,6 +524,15 @@ class TestSearchPromotionsAddView(WagtailTestUtils, TestCase):
         # Check that the search pick was created
         self.assertTrue(Query.get("test").editors_picks.filter(page_id=1).exists())
 
+        # Check that the creation was logged exactly once
+        search_pick = Query.get("test").editors_picks.get(page_id=1)
+        self.assertEqual(
+            ModelLogEntry.objects.filter(
+                action="wagtail.create", object_id=str(search_pick.id)
+            ).count(),
+            1,
+        )
+
     def test_post_with_external_link(self):
         # Submit
         post_data = {
@@ -657,6 +699,90 @@ class TestSearchPromotionsEditView(WagtailTestUtils, TestCase):
             "Description has changed",
         )
 
+    def test_post_change_query_string(self):
+        # Submit a new query string without changing the recommendations
+        post_data = {
+            "query_string": "Goodbye",
+            "editors_picks-TOTAL_FORMS": 2,
+            "editors_picks-INITIAL_FORMS": 2,
+            "editors_picks-MAX_NUM_FORMS": 1000,
+            "editors_picks-0-id": self.search_pick.id,
+            "editors_picks-0-DELETE": "",
+            "editors_picks-0-ORDER": 0,
+            "editors_picks-0-page": 1,
+            "editors_picks-0-description": "Root page",
+            "editors_picks-1-id": self.search_pick_2.id,
+            "editors_picks-1-DELETE": "",
+            "editors_picks-1-ORDER": 1,
+            "editors_picks-1-page": 2,
+            "editors_picks-1-description": "Homepage",
+        }
+        response = self.client.post(
+            reverse("wagtailsearchpromotions:edit", args=(self.query.id,)), post_data
+        )
+        self.assertRedirects(response, reverse("wagtailsearchpromotions:index"))
+
+        # The recommendations should be moved to the new query
+        new_query = Query.objects.get(query_string="goodbye")
+        self.assertEqual(
+            set(new_query.editors_picks.values_list("id", flat=True)),
+            {self.search_pick.id, self.search_pick_2.id},
+        )
+        self.assertFalse(self.query.editors_picks.exists())
+
+        # Moving the recommendations should be logged against each of them
+        self.assertEqual(
+            set(
+                ModelLogEntry.objects.filter(action="wagtail.edit").values_list(
+                    "object_id", "label"
+                )
+            ),
+            {
+                (str(self.search_pick.id), "goodbye - Root"),
+                (
+                    str(self.search_pick_2.id),
+                    f"goodbye - {Page.objects.get(id=2).title}",
+                ),
+            },
+        )
+
+    def test_post_invalid_query_string(self):
+        post_data = {
+            "query_string": "",
+            "editors_picks-TOTAL_FORMS": 2,
+            "editors_picks-INITIAL_FORMS": 2,
+            "editors_picks-MAX_NUM_FORMS": 1000,
+            "editors_picks-0-id": self.search_pick.id,
+            "editors_picks-0-DELETE": "",
+            "editors_picks-0-ORDER": 0,
+            "editors_picks-0-page": 1,
+            "editors_picks-0-description": "Description has changed",
+            "editors_picks-1-id": self.search_pick_2.id,
+            "editors_picks-1-DELETE": "",
+            "editors_picks-1-ORDER": 1,
+            "editors_picks-1-page": 2,
+            "editors_picks-1-description": "Homepage",
+        }
+        response = self.client.post(
+            reverse("wagtailsearchpromotions:edit", args=(self.query.id,)), post_data
+        )
+
+        # The query form should be redisplayed with the submitted recommendations
+        self.assertEqual(response.status_code, 200)
+        self.assertFormError(
+            response.context["query_form"], "query_string", "This field is required."
+        )
+        searchpicks_formset = response.context["searchpicks_formset"]
+        self.assertTrue(searchpicks_formset.is_bound)
+        self.assertEqual(len(searchpicks_formset.forms), 2)
+        self.assertContains(response, "Description has changed")
+
+        # The recommendations should not have been changed
+        self.assertEqual(
+            SearchPromotion.objects.get(id=self.search_pick.id).description,
+            "Root page",
+        )
+
     def test_post_reorder(self):
         # Check order before reordering
         self.assertEqual(Query.get("Hello").editors_picks.all()[0], self.search_pick)
@@ -698,6 +824,34 @@ class TestSearchPromotionsEditView(WagtailTestUtils, TestCase):
         self.assertEqual(Query.get("Hello").editors_picks.all()[0], self.search_pick_2)
         self.assertEqual(Query.get("Hello").editors_picks.all()[1], self.search_pick)
 
+    def test_post_delete_updates_order_of_unchanged_recommendations(self):
+        post_data = {
+            "query_string": "Hello",
+            "editors_picks-TOTAL_FORMS": 2,
+            "editors_picks-INITIAL_FORMS": 2,
+            "editors_picks-MAX_NUM_FORMS": 1000,
+            "editors_picks-0-id": self.search_pick.id,
+            "editors_picks-0-DELETE": 1,
+            "editors_picks-0-ORDER": 1,
+            "editors_picks-0-page": 1,
+            "editors_picks-0-description": "Root page",
+            "editors_picks-1-id": self.search_pick_2.id,
+            "editors_picks-1-DELETE": "",
+            "editors_picks-1-ORDER": 2,
+            "editors_picks-1-page": 2,
+            "editors_picks-1-description": "Homepage",
+        }
+        response = self.client.post(
+            reverse("wagtailsearchpromotions:edit", args=(self.query.id,)), post_data
+        )
+        self.assertRedirects(response, reverse("wagtailsearchpromotions:index"))
+
+        # The remaining recommendation moves to the top without being edited
+        self.assertEqual(
+            SearchPromotion.objects.get(id=self.search_pick_2.id).sort_order, 0
+        )
+        self.assertFalse(ModelLogEntry.objects.filter(action="wagtail.edit").exists())
+
     def test_post_delete_recommendation(self):
         # Submit
         post_data = {
@@ -731,6 +885,12 @@ class TestSearchPromotionsEditView(WagtailTestUtils, TestCase):
         # The other recommendation should still exist
         self.assertTrue(SearchPromotion.objects.filter(id=self.search_pick.id).exists())
 
+        # The deletion should be logged against the deleted recommendation
+        log_entry = ModelLogEntry.objects.get(action="wagtail.delete")
+        self.assertEqual(log_entry.object_id, str(self.search_pick_2.id))
+        self.assertEqual(log_entry.label, f"hello - {Page.objects.get(id=2).title}")
+        self.assertEqual(log_entry.user, self.user)
+
     def test_post_without_recommendations(self):
         # Submit
         post_data = {
@@ -802,6 +962,24 @@ class TestSearchPromotionsDeleteView(WagtailTestUtils, TestCase):
             SearchPromotion.objects.filter(id=self.search_pick.id).exists()
         )
 
+        # Both deletions should be logged
+        self.assertEqual(
+            set(
+                ModelLogEntry.objects.filter(action="wagtail.delete").values_list(
+                    "object_id", flat=True
+                )
+            ),
+            {str(self.search_pick.id), str(self.search_pick_2.id)},
+        )
+        self.assertEqual(
+            set(
+                ModelLogEntry.objects.filter(action="wagtail.delete").values_list(
+                    "label", flat=True
+                )
+            ),
+            {"hello - Root", f"hello - {Page.objects.get(id=2).title}"},
+        )
+
 
 class TestGarbageCollectManagementCommand(TestCase):
     def test_garbage_collect_command(self):
@@ -859,6 +1037,24 @@ class TestGarbageCollectManagementCommand(TestCase):
             0,
         )
 
+        # View counts should be updated from the remaining daily hits
+        self.assertEqual(
+            set(
+                Query.objects.filter(id__in=recent_query_ids).values_list(
+                    "views_past_week", flat=True
+                )
+            ),
+            {1},
+        )
+        self.assertEqual(
+            set(
+                Query.objects.filter(id__in=promoted_query_ids).values_list(
+                    "views_past_week", flat=True
+                )
+            ),
+            {0},
+        )
+
 
 class TestQueryChooserView(WagtailTestUtils, TestCase):
     def setUp(self):
@@ -881,12 +1077,60 @@ class TestQueryChooserView(WagtailTestUtils, TestCase):
         self.assertEqual(response.status_code, 200)
 
     def test_pagination(self):
-        # page numbers in range should be accepted
-        response = self.get({"p": 1})
+        for i in range(12):
+            query = Query.get(f"query {i}")
+            for j in range(i + 1):
+                query.add_hit()
+
+        response = self.client.get(
+            "/admin/searchpicks/queries/chooser/results/",
+        )
         self.assertEqual(response.status_code, 200)
-        # page numbers out of range should return 404
-        response = self.get({"p": 9999})
+        queries = response.context["queries"]
+        self.assertEqual(len(queries), 10)
+        self.assertEqual(queries[0]["query_string"], "query 11")
+        self.assertEqual(queries[0]["hits"], 12)
+        self.assertFalse(response.context["has_previous"])
+        next_cursor = response.context["next_cursor"]
+        self.assertEqual(next_cursor, "%d_%d" % (3, Query.get("query 2").id))
+
+        # the next page should start after the cursor
+        response = self.client.get(
+            "/admin/searchpicks/queries/chooser/results/", {"after": next_cursor}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [query["query_string"] for query in response.context["queries"]],
+            ["query 1", "query 0"],
+        )
+        self.assertTrue(response.context["has_previous"])
+        self.assertIsNone(response.context["next_cursor"])
+
+    def test_pagination_invalid_cursor(self):
+        # malformed cursors should return 404
+        response = self.get({"after": "Hello World!"})
         self.assertEqual(response.status_code, 404)
+        # cursors past the last result should return 404
+        response = self.get({"after": "0_0"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_results_are_cached(self):
+        popular_query = Query.get("popular")
+        popular_query.add_hit()
+        unpopular_query = Query.get("unpopular")
+        response = self.get()
+        self.assertContains(response, "popular")
+        self.assertNotContains(response, "unpopular")
+
+        # Hits alone do not invalidate the cached results
+        unpopular_query.add_hit()
+        response = self.get()
+        self.assertNotContains(response, "unpopular")
+
+        # The cached results expire after a short while
+        with freeze_time(timezone.now() + timedelta(seconds=61)):
+            response = self.get()
+        self.assertContains(response, "unpopular")
 
 
 class TestHitCounter(TestCase):
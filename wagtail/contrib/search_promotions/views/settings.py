@@ -1,10 +1,23 @@
-from django.core.paginator import InvalidPage, Paginator
+import copy
+from functools import lru_cache
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.db import transaction
-from django.db.models import Sum, functions
+from django.db.models import (
+    Count,
+    Exists,
+    F,
+    OuterRef,
+    Prefetch,
+    Q,
+    Subquery,
+)
 from django.http import Http404
 from django.shortcuts import get_object_or_404, redirect
 from django.template.response import TemplateResponse
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext as _
 from django.utils.translation import gettext_lazy
 
@@ -12,18 +25,32 @@ from wagtail.admin import messages
 from wagtail.admin.auth import permission_required
 from wagtail.admin.forms.search import SearchForm
 from wagtail.admin.modal_workflow import render_modal_workflow
-from wagtail.admin.ui.tables import Column, RelatedObjectsColumn, TitleColumn
+from wagtail.admin.ui.tables import Column, TitleColumn
 from wagtail.admin.views import generic
 from wagtail.contrib.search_promotions import forms, models
 from wagtail.contrib.search_promotions.models import Query, SearchPromotion
-from wagtail.log_actions import log
+from wagtail.coreutils import BatchCreator, safe_md5
+from wagtail.log_actions import get_active_log_context, log
+from wagtail.log_actions import registry as log_registry
+from wagtail.models import ModelLogEntry
 from wagtail.permission_policies.base import ModelPermissionPolicy
 from wagtail.search.utils import normalise_query_string
 
+CHOOSER_RESULTS_CACHE_TIMEOUT = 60
+
 
-class SearchPromotionColumn(RelatedObjectsColumn):
+class SearchPromotionColumn(Column):
     cell_template_name = "wagtailsearchpromotions/search_promotion_column.html"
 
+    def get_cell_context_data(self, instance, parent_context):
+        context = super().get_cell_context_data(instance, parent_context)
+        # Only a preview of the promoted results is fetched, so use the annotated
+        # count (if available) to show how many are not listed
+        count = getattr(instance, "editors_picks_count", None)
+        if count is not None:
+            context["remaining_count"] = count - len(context["value"])
+        return context
+
 
 class IndexView(generic.IndexView):
     model = Query
@@ -40,6 +67,7 @@ class IndexView(generic.IndexView):
     default_ordering = "query_string"
     add_url_name = "wagtailsearchpromotions:add"
     add_item_label = gettext_lazy("Add new promoted result")
+    search_promotions_preview_limit = 5
     columns = [
         TitleColumn(
             "query_string",
@@ -50,11 +78,13 @@ class IndexView(generic.IndexView):
         ),
         SearchPromotionColumn(
             "editors_picks",
+            accessor="preview_editors_picks",
             label=gettext_lazy("Promoted results"),
             width="40%",
         ),
         Column(
             "views",
+            accessor="views_past_week",
             label=gettext_lazy("Views (past week)"),
             width="20%",
             sort_key="views",
@@ -62,18 +92,54 @@ class IndexView(generic.IndexView):
     ]
 
     def get_base_queryset(self):
-        # Use a subquery to filter out the Query objects that do not have a
-        # SearchPromotion instead of using .filter(editors_picks__isnull=False).
-        # The latter would use a JOIN which would result in duplicate rows before
-        # the sum is calculated, causing the sum to be incorrect.
-        has_promotions = SearchPromotion.objects.values_list("query_id", flat=True)
-        queryset = self.model.objects.filter(pk__in=has_promotions)
-
-        # Prevent N+1 queries by annotating the sum instead of using the
-        # Query.hits property and prefetching the related editors_picks.
+        # Use an EXISTS subquery to filter out the Query objects that do not have
+        # a SearchPromotion instead of using .filter(editors_picks__isnull=False).
+        # The latter would use a JOIN which would result in duplicate rows.
+        has_promotions = Exists(SearchPromotion.objects.filter(query_id=OuterRef("pk")))
+        queryset = self.model.objects.filter(has_promotions)
+
+        # Count the search promotions in a subquery, so that only a preview of
+        # them needs to be fetched for each Query.
+        editors_picks_count = (
+            SearchPromotion.objects.filter(query_id=OuterRef("pk"))
+            .order_by()
+            .values("query_id")
+            .annotate(count=Count("*"))
+            .values("count")
+        )
+
+        # Prevent N+1 queries by using the views_past_week field (updated by
+        # the searchpromotions_garbage_collect command) instead of the Query.hits
+        # property, and prefetching the related editors_picks, with their pages
+        # fetched in the same query.
         queryset = queryset.annotate(
-            views=functions.Coalesce(Sum("daily_hits__hits"), 0)
-        ).prefetch_related("editors_picks", "editors_picks__page")
+            editors_picks_count=Subquery(editors_picks_count),
+        ).prefetch_related(
+            Prefetch(
+                "editors_picks",
+                queryset=SearchPromotion.objects.select_related("page")
+                .only(
+                    "id",
+                    "query",
+                    "sort_order",
+                    "external_link_url",
+                    "external_link_text",
+                    "page",
+                    "page__id",
+                    "page__title",
+                )
+                .order_by("sort_order")[: self.search_promotions_preview_limit],
+                # A sliced prefetch cannot be applied to the related manager, so
+                # store the preview in a list instead
+                to_attr="preview_editors_picks",
+            )
+        )
+
+        # Only fetch the fields that are displayed in the listing. The views
+        # alias keeps existing ?ordering=views links working.
+        queryset = queryset.only("id", "query_string", "views_past_week").alias(
+            views=F("views_past_week")
+        )
         return queryset
 
     def get_breadcrumbs_items(self):
@@ -82,42 +148,103 @@ class IndexView(generic.IndexView):
         return breadcrumbs
 
 
+def log_searchpicks(actions):
+    """
+    Log an iterable of (search_pick, action) pairs, inserting the log entries
+    in batches where possible.
+    """
+    log_entry_model = log_registry.get_log_model_for_model(SearchPromotion)
+    if log_entry_model is not ModelLogEntry:
+        # Custom log entry models may populate extra fields, so log individually
+        for search_pick, action in actions:
+            log(search_pick, action)
+        return
+
+    log_context = get_active_log_context()
+    content_type = ContentType.objects.get_for_model(
+        SearchPromotion, for_concrete_model=False
+    )
+    timestamp = timezone.now()
+    batch = BatchCreator(max_size=500, model=ModelLogEntry)
+    for search_pick, action in actions:
+        batch.add(
+            content_type=content_type,
+            label=ModelLogEntry.objects.get_instance_title(search_pick),
+            action=action,
+            timestamp=timestamp,
+            object_id=str(search_pick.pk),
+            user=log_context.user,
+            uuid=log_context.uuid,
+        )
+    batch.process()
+
+
+@lru_cache(maxsize=None)
+def get_searchpicks_media():
+    """
+    Return the combined media of the query form and search picks formset. This
+    does not vary between requests, so it is only built once.
+    """
+    return forms.QueryForm().media + forms.SearchPromotionsFormSet().media
+
+
 def save_searchpicks(query, new_query, searchpicks_formset):
     # Save
     if searchpicks_formset.is_valid():
-        # Set sort_order
+        # Set sort_order. Changed forms are saved with their new order by the
+        # formset, so only the remaining reordered picks need to be updated.
+        reordered_search_picks = []
         for i, form in enumerate(searchpicks_formset.ordered_forms):
+            if (
+                form.instance.pk
+                and not form.has_changed()
+                and form.instance.sort_order != i
+            ):
+                reordered_search_picks.append(form.instance)
             form.instance.sort_order = i
 
-            # Make sure the form is marked as changed so it gets saved with the new order
-            form.has_changed = lambda: True
-
-        # log deleted items before saving, otherwise we lose their IDs
-        items_for_deletion = [
-            form.instance
+        # Copy deleted items before saving, as deleting them clears their IDs
+        # which we need for logging
+        log_actions = [
+            (copy.copy(form.instance), "wagtail.delete")
             for form in searchpicks_formset.deleted_forms
             if form.instance.pk
         ]
         with transaction.atomic():
-            for search_pick in items_for_deletion:
-                log(search_pick, "wagtail.delete")
-
             searchpicks_formset.save()
+            SearchPromotion.objects.bulk_update(
+                reordered_search_picks, ["sort_order"], batch_size=500
+            )
 
             for search_pick in searchpicks_formset.new_objects:
-                log(search_pick, "wagtail.create")
+                log_actions.append((search_pick, "wagtail.create"))
 
             # If query was changed, move all search picks to the new query
             if query != new_query:
-                searchpicks_formset.get_queryset().update(query=new_query)
-                # log all items in the formset as having changed
-                for search_pick, changed_fields in searchpicks_formset.changed_objects:
-                    log(search_pick, "wagtail.edit")
+                # log all existing items as having changed, as they are moved
+                moved_search_picks = list(
+                    query.editors_picks.select_related("page").exclude(
+                        pk__in=[
+                            search_pick.pk
+                            for search_pick in searchpicks_formset.new_objects
+                        ]
+                    )
+                )
+                SearchPromotion.objects.filter(query_id=query.pk).update(
+                    query=new_query
+                )
+                for search_pick in moved_search_picks:
+                    search_pick.query = new_query
+                    log_actions.append((search_pick, "wagtail.edit"))
             else:
                 # only log objects with actual changes
-                for search_pick, changed_fields in searchpicks_formset.changed_objects:
-                    if changed_fields:
-                        log(search_pick, "wagtail.edit")
+                log_actions.extend(
+                    (search_pick, "wagtail.edit")
+                    for search_pick, changed_fields in searchpicks_formset.changed_objects
+                    if changed_fields
+                )
+
+            log_searchpicks(log_actions)
 
         return True
     else:
@@ -137,8 +264,6 @@ def add(request):
                 request.POST, instance=query
             )
             if save_searchpicks(query, query, searchpicks_formset):
-                for search_pick in searchpicks_formset.new_objects:
-                    log(search_pick, "wagtail.create")
                 messages.success(
                     request,
                     _("Editor's picks for '%(query)s' created.") % {"query": query},
@@ -151,14 +276,10 @@ def add(request):
                 )
                 return redirect("wagtailsearchpromotions:index")
             else:
-                if len(searchpicks_formset.non_form_errors()):
+                non_form_errors = searchpicks_formset.non_form_errors()
+                if non_form_errors:
                     # formset level error (e.g. no forms submitted)
-                    messages.error(
-                        request,
-                        " ".join(
-                            error for error in searchpicks_formset.non_form_errors()
-                        ),
-                    )
+                    messages.error(request, " ".join(non_form_errors))
                 else:
                     # specific errors will be displayed within form fields
                     messages.error(
@@ -177,7 +298,7 @@ def add(request):
         {
             "query_form": query_form,
             "searchpicks_formset": searchpicks_formset,
-            "media": query_form.media + searchpicks_formset.media,
+            "media": get_searchpicks_media(),
             # Remove these when this view is refactored to a generic.CreateView subclass.
             # Avoid defining new translatable strings.
             "submit_button_label": generic.CreateView.submit_button_label,
@@ -193,13 +314,19 @@ def edit(request, query_id):
     if request.method == "POST":
         # Get query
         query_form = forms.QueryForm(request.POST)
-        # and the recommendations
+        # and the recommendations. These are only validated and saved if the
+        # query form is valid, but are always redisplayed as submitted.
         searchpicks_formset = forms.SearchPromotionsFormSet(
             request.POST, instance=query
         )
 
         if query_form.is_valid():
-            new_query = Query.get(query_form["query_string"].value())
+            # Avoid looking up the query again if the search term is unchanged
+            query_string = normalise_query_string(query_form["query_string"].value())
+            if query_string == query.query_string:
+                new_query = query
+            else:
+                new_query = Query.get(query_string)
 
             # Save search picks
             if save_searchpicks(query, new_query, searchpicks_formset):
@@ -215,20 +342,15 @@ def edit(request, query_id):
                 )
                 return redirect("wagtailsearchpromotions:index")
             else:
-                if len(searchpicks_formset.non_form_errors()):
-                    messages.error(
-                        request,
-                        " ".join(
-                            error for error in searchpicks_formset.non_form_errors()
-                        ),
-                    )
+                non_form_errors = searchpicks_formset.non_form_errors()
+                if non_form_errors:
+                    messages.error(request, " ".join(non_form_errors))
                     # formset level error (e.g. no forms submitted)
                 else:
                     messages.error(
                         request, _("Recommendations have not been saved due to errors")
                     )
                     # specific errors will be displayed within form fields
-
     else:
         query_form = forms.QueryForm(initial={"query_string": query.query_string})
         searchpicks_formset = forms.SearchPromotionsFormSet(instance=query)
@@ -240,7 +362,7 @@ def edit(request, query_id):
             "query_form": query_form,
             "searchpicks_formset": searchpicks_formset,
             "query": query,
-            "media": query_form.media + searchpicks_formset.media,
+            "media": get_searchpicks_media(),
             # Remove these when this view is refactored to a generic.CreateView subclass.
             # Avoid defining new translatable strings.
             "submit_button_label": generic.EditView.submit_button_label,
@@ -259,11 +381,20 @@ def delete(request, query_id):
     query = get_object_or_404(Query, id=query_id)
 
     if request.method == "POST":
-        editors_picks = query.editors_picks.all()
+        # Iterate over the search picks in chunks to avoid loading them all
+        # into memory, only fetching the fields needed for their log entries.
+        # The titles of their pages are used in the log entries, so fetch the
+        # pages in the same query.
+        editors_picks = (
+            query.editors_picks.select_related("page")
+            .only("id", "query", "page", "external_link_text", "page__title")
+            .iterator(chunk_size=500)
+        )
         with transaction.atomic():
-            for search_pick in editors_picks:
-                log(search_pick, "wagtail.delete")
-            editors_picks.delete()
+            log_searchpicks(
+                (search_pick, "wagtail.delete") for search_pick in editors_picks
+            )
+            query.editors_picks.all().delete()
         messages.success(request, _("Editor's picks deleted."))
         return redirect("wagtailsearchpromotions:index")
 
@@ -276,26 +407,83 @@ def delete(request, query_id):
     )
 
 
+def get_most_popular_page(queries, after_hits=None, after_id=None, limit=10):
+    """
+    Return a page of queries from a queryset returned by Query.get_most_popular(),
+    starting after the query with the given hits and ID, and whether there is a
+    next page. Unlike Paginator, this does not need to count all of the queries.
+    """
+    queries = queries.order_by("-_hits", "-id")
+    if after_hits is not None and after_id is not None:
+        queries = queries.filter(
+            Q(_hits__lt=after_hits) | Q(_hits=after_hits, id__lt=after_id)
+        )
+
+    # Fetch one extra query to find out whether there is a next page
+    results = list(queries[: limit + 1])
+    return results[:limit], len(results) > limit
+
+
 def chooser(request, get_results=False):
     # Get most popular queries
     queries = models.Query.get_most_popular()
+    query_string = ""
 
     # If searching, filter results by query string
     if "q" in request.GET:
         searchform = SearchForm(request.GET)
         if searchform.is_valid():
-            query_string = searchform.cleaned_data["q"]
-            queries = queries.filter(
-                query_string__icontains=normalise_query_string(query_string)
-            )
+            query_string = normalise_query_string(searchform.cleaned_data["q"])
+            queries = queries.filter(query_string__icontains=query_string)
     else:
         searchform = SearchForm()
 
-    paginator = Paginator(queries, per_page=10)
-    try:
-        queries = paginator.page(request.GET.get("p", 1))
-    except InvalidPage:
-        raise Http404
+    # Results are paginated with a cursor of the hits and ID of the last query
+    # on the previous page, to avoid counting all of the most popular queries
+    after = request.GET.get("after")
+    if after:
+        try:
+            after_hits, after_id = (int(value) for value in after.split("_"))
+        except ValueError:
+            raise Http404
+        # Rebuild the cursor from the parsed values, so that equivalent cursors
+        # share the same cache key and the key stays safe for all cache backends
+        after = "%d_%d" % (after_hits, after_id)
+    else:
+        after = ""
+        after_hits = after_id = None
+
+    # The aggregate behind get_most_popular() is expensive, so cache the results
+    # of each page for a short while. Hit counts are allowed to be slightly out
+    # of date, so the cached results are left to expire rather than invalidated.
+    cache_key = "wagtailsearchpromotions_query_chooser:%s:%s" % (
+        safe_md5(query_string.encode(), usedforsecurity=False).hexdigest(),
+        after,
+    )
+
+    def get_page_results():
+        results, has_next = get_most_popular_page(
+            queries, after_hits=after_hits, after_id=after_id
+        )
+        if after and not results:
+            raise Http404
+        return {
+            "results": [
+                {
+                    "id": query.id,
+                    "query_string": query.query_string,
+                    "hits": query._hits,
+                }
+                for query in results
+            ],
+            "next_cursor": (
+                "%d_%d" % (results[-1]._hits, results[-1].id) if has_next else None
+            ),
+        }
+
+    page_results = cache.get_or_set(
+        cache_key, get_page_results, CHOOSER_RESULTS_CACHE_TIMEOUT
+    )
 
     # Render
     if get_results:
@@ -303,7 +491,9 @@ def chooser(request, get_results=False):
             request,
             "wagtailsearchpromotions/queries/chooser/results.html",
             {
-                "queries": queries,
+                "queries": page_results["results"],
+                "has_previous": bool(after),
+                "next_cursor": page_results["next_cursor"],
             },
         )
     else:
@@ -312,7 +502,9 @@ def chooser(request, get_results=False):
             "wagtailsearchpromotions/queries/chooser/chooser.html",
             None,
             {
-                "queries": queries,
+                "queries": page_results["results"],
+                "has_previous": bool(after),
+                "next_cursor": page_results["next_cursor"],
                 "searchform": searchform,
             },
             json_data={"step": "chooser"},
@@ -1,6 +1,6 @@
 import operator
 import re
-from functools import partial
+from functools import lru_cache, partial
 
 from django.apps import apps
 from django.db import connections
@@ -73,8 +73,13 @@ filters_regexp = re.compile(r'\b(\w+):(\w+|"[^"]+"|\'[^\']+\')')
 
 
 def normalise_query_string(query_string):
-    # Truncate query string
-    query_string = query_string[:MAX_QUERY_STRING_LENGTH]
+    # Truncate query string before normalising it, so that the cache below is
+    # keyed on strings of a bounded length
+    return _normalise_truncated_query_string(query_string[:MAX_QUERY_STRING_LENGTH])
+
+
+@lru_cache(maxsize=4096)
+def _normalise_truncated_query_string(query_string):
     # Convert query_string to lowercase
     query_string = query_string.lower()
 